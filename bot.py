@@ -1,8 +1,17 @@
+import asyncio
+import contextlib
+import functools
+import importlib.util
+import json
 import logging
 import os
+import re
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler, CallbackQueryHandler
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler, CallbackQueryHandler
 
 # Google Sheets API
 import gspread
@@ -23,6 +32,9 @@ logger = logging.getLogger(__name__)
 # Define states for the data collection conversation
 GET_DATA = range(1)
 
+# Maximum number of data points (columns) a single submission can hold
+MAX_DATA_POINTS = int(os.environ.get("MAX_DATA_POINTS", "64"))
+
 # Define states for the search conversation
 ASKING_FOR_SEARCH_QUERY, RECEIVING_SEARCH_QUERY = range(2)
 
@@ -31,26 +43,286 @@ ASKING_FOR_SEARCH_QUERY, RECEIVING_SEARCH_QUERY = range(2)
 # Replace with the path to your service account credentials JSON file
 # It's recommended to use environment variables or a secure method for credentials in production
 GOOGLE_SHEETS_CREDENTIALS_FILE = os.environ.get("GOOGLE_SHEETS_CREDENTIALS_FILE", "credentials.json")
-# Replace with the name or ID of your Google Sheet
+# Replace with the ID of your Google Sheet (the long key in its URL); opening by ID goes
+# straight to the Sheets API instead of searching Drive for the sheet by name
+GOOGLE_SHEET_ID = os.environ.get("GOOGLE_SHEET_ID")
+# Name of your Google Sheet, only used when GOOGLE_SHEET_ID is not set
 GOOGLE_SHEET_NAME = os.environ.get("GOOGLE_SHEET_NAME", "AI Training Dataset")
 # Replace with the name of the specific worksheet (tab) you want to use
 WORKSHEET_NAME = os.environ.get("WORKSHEET_NAME", "Sheet1")
-
-try:
-    # Authenticate with Google Sheets
+# A1 range the rows are appended to, resolved once so appends need no extra metadata lookups
+SHEET_RANGE = "'{}'!A1".format(WORKSHEET_NAME.replace("'", "''"))
+
+# Size of the thread pool that runs blocking gspread and search calls off the event loop
+BLOCKING_IO_WORKERS = int(os.environ.get("BLOCKING_IO_WORKERS", "8"))
+# Installed as the event loop's default executor in post_init; threads are only started on first use
+BLOCKING_IO_EXECUTOR = ThreadPoolExecutor(max_workers=BLOCKING_IO_WORKERS, thread_name_prefix="blocking-io")
+
+# Connection attempts made by get_worksheet before giving up, and the cap on the backoff between them
+SHEETS_CONNECT_ATTEMPTS = int(os.environ.get("SHEETS_CONNECT_ATTEMPTS", "5"))
+SHEETS_CONNECT_MAX_BACKOFF = float(os.environ.get("SHEETS_CONNECT_MAX_BACKOFF", "30"))
+
+worksheet = None # Opened lazily by get_worksheet and reused for the lifetime of the process
+WORKSHEET_LOCK = asyncio.Lock()
+
+# Sheets API requests allowed per minute, kept just under the 60 requests/minute per-user quota
+SHEETS_REQUESTS_PER_MINUTE = int(os.environ.get("SHEETS_REQUESTS_PER_MINUTE", "55"))
+
+class AsyncRateLimiter:
+    """Async context manager that lets at most max_rate callers in per time_period seconds.
+
+    Callers that would exceed the rate wait their turn, in arrival order.
+    """
+
+    def __init__(self, max_rate: int, time_period: float):
+        self.max_rate = max_rate
+        self.time_period = time_period
+        self._timestamps = deque()
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        pass
+
+    async def acquire(self) -> None:
+        """Waits until one more caller fits within the rate."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._timestamps and now - self._timestamps[0] >= self.time_period:
+                    self._timestamps.popleft()
+                if len(self._timestamps) < self.max_rate:
+                    self._timestamps.append(now)
+                    return
+                await asyncio.sleep(self.time_period - (now - self._timestamps[0]))
+
+SHEETS_LIMITER = AsyncRateLimiter(SHEETS_REQUESTS_PER_MINUTE, 60)
+
+async def call_sheets(func, *args, api_requests: int = 1, **kwargs):
+    """Runs a blocking gspread call in the thread pool, within the Sheets API rate limit.
+
+    api_requests is the number of API requests the call makes, each counted against the limit.
+    """
+    for _ in range(api_requests):
+        await SHEETS_LIMITER.acquire()
+    return await asyncio.to_thread(func, *args, **kwargs)
+
+@functools.lru_cache(maxsize=None)
+def load_credentials_info() -> dict:
+    """Reads and parses the service account key file once; later calls reuse the parsed key."""
+    with open(GOOGLE_SHEETS_CREDENTIALS_FILE, "rb") as credentials_file:
+        return json.load(credentials_file)
+
+def authorize_client():
+    """Builds an authorized gspread client. Blocking, but makes no API requests yet."""
     scopes = [
         'https://www.googleapis.com/auth/spreadsheets',
         'https://www.googleapis.com/auth/drive'
     ]
-    credentials = Credentials.from_service_account_file(
-        GOOGLE_SHEETS_CREDENTIALS_FILE, scopes=scopes)
-    client = gspread.authorize(credentials)
-    spreadsheet = client.open(GOOGLE_SHEET_NAME)
-    worksheet = spreadsheet.worksheet(WORKSHEET_NAME)
-    logger.info("Successfully connected to Google Sheets.")
-except Exception as e:
-    logger.error(f"Error connecting to Google Sheets: {e}")
-    worksheet = None # Set worksheet to None if connection fails
+    credentials = Credentials.from_service_account_info(
+        load_credentials_info(), scopes=scopes)
+    return gspread.authorize(credentials)
+
+async def open_worksheet():
+    """Authenticates with Google Sheets and opens the worksheet, rate-limiting each API request."""
+    client = await asyncio.to_thread(authorize_client)
+    if GOOGLE_SHEET_ID:
+        # One request for the spreadsheet metadata
+        spreadsheet = await call_sheets(client.open_by_key, GOOGLE_SHEET_ID)
+    else:
+        logger.warning("GOOGLE_SHEET_ID is not set; looking up the spreadsheet by name via Drive.")
+        # A Drive search, then a request for the spreadsheet metadata
+        spreadsheet = await call_sheets(client.open, GOOGLE_SHEET_NAME, api_requests=2)
+    # One request for the worksheet metadata
+    return await call_sheets(spreadsheet.worksheet, WORKSHEET_NAME)
+
+async def get_worksheet(attempts: int = SHEETS_CONNECT_ATTEMPTS):
+    """Returns the worksheet, connecting on first use and retrying with exponential backoff."""
+    global worksheet
+    async with WORKSHEET_LOCK:
+        if worksheet is not None:
+            return worksheet
+
+        for attempt in range(1, attempts + 1):
+            try:
+                worksheet = await open_worksheet()
+                logger.info("Successfully connected to Google Sheets.")
+                return worksheet
+            except Exception as e:
+                logger.error("Error connecting to Google Sheets (attempt %d/%d): %s", attempt, attempts, e)
+                if attempt == attempts:
+                    raise
+                await asyncio.sleep(min(2 ** (attempt - 1), SHEETS_CONNECT_MAX_BACKOFF))
+
+# --- Batched Sheet Writes ---
+# Submissions are buffered here and written with a single values.append request,
+# either every SHEET_FLUSH_INTERVAL seconds or once SHEET_FLUSH_BATCH_SIZE rows are waiting
+SHEET_FLUSH_INTERVAL = float(os.environ.get("SHEET_FLUSH_INTERVAL", "5"))
+SHEET_FLUSH_BATCH_SIZE = int(os.environ.get("SHEET_FLUSH_BATCH_SIZE", "50"))
+# New submissions are refused while this many rows are waiting to be written...
+SHEET_MAX_PENDING_ROWS = int(os.environ.get("SHEET_MAX_PENDING_ROWS", "1000"))
+# ...or after this many flushes in a row have failed, until a flush succeeds again
+SHEET_MAX_FLUSH_FAILURES = int(os.environ.get("SHEET_MAX_FLUSH_FAILURES", "3"))
+
+PENDING_ROWS: list[list[str]] = []
+PENDING_ROWS_LOCK = asyncio.Lock()
+FLUSH_REQUESTED = asyncio.Event()
+FLUSHER_STOPPING = asyncio.Event()
+sheet_flusher_task = None # Started in post_init; kept here rather than in bot_data, which may be pickled
+failed_flushes = 0 # Consecutive failed flushes, reset by the next successful one
+
+def sheets_unavailable() -> bool:
+    """Returns True once enough flushes in a row have failed to treat Google Sheets as down."""
+    return failed_flushes >= SHEET_MAX_FLUSH_FAILURES
+
+async def queue_row(row: list[str]) -> bool:
+    """Adds a row to the pending buffer and wakes the flusher if the batch is full.
+
+    Returns False, without queueing the row, if Google Sheets is unavailable or the buffer is full.
+    """
+    async with PENDING_ROWS_LOCK:
+        if sheets_unavailable() or len(PENDING_ROWS) >= SHEET_MAX_PENDING_ROWS:
+            return False
+        PENDING_ROWS.append(row)
+        if len(PENDING_ROWS) >= SHEET_FLUSH_BATCH_SIZE:
+            FLUSH_REQUESTED.set()
+    return True
+
+async def flush_pending_rows() -> None:
+    """Writes all pending rows to the Google Sheet in a single request."""
+    global failed_flushes
+    async with PENDING_ROWS_LOCK:
+        if not PENDING_ROWS:
+            return
+        batch = PENDING_ROWS[:]
+        PENDING_ROWS.clear()
+
+    written = False
+    try:
+        # Once Sheets is considered down, make a single connection attempt per flush instead of backing off
+        sheet = await get_worksheet(attempts=1 if sheets_unavailable() else SHEETS_CONNECT_ATTEMPTS)
+        await call_sheets(
+            sheet.spreadsheet.values_append, SHEET_RANGE,
+            params={'valueInputOption': 'RAW', 'insertDataOption': 'INSERT_ROWS'},
+            body={'values': batch})
+        written = True
+        failed_flushes = 0
+        logger.info("Added %d rows to sheet.", len(batch))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Rows added to sheet: %s", batch)
+    except Exception as e:
+        failed_flushes += 1
+        logger.error("Error appending data to Google Sheet (%d failed flushes in a row): %s", failed_flushes, e)
+    finally:
+        if not written:
+            # Put the rows back in front of anything queued meanwhile so they are retried in order.
+            # This also runs if the flush is cancelled, and involves no await so it cannot be interrupted.
+            PENDING_ROWS[:0] = batch
+
+async def sheet_flusher() -> None:
+    """Background task that periodically flushes the pending rows until FLUSHER_STOPPING is set."""
+    while not FLUSHER_STOPPING.is_set():
+        try:
+            await asyncio.wait_for(FLUSH_REQUESTED.wait(), timeout=SHEET_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        FLUSH_REQUESTED.clear()
+        await flush_pending_rows()
+
+    # Write out whatever was queued while the last flush was running
+    await flush_pending_rows()
+    if PENDING_ROWS:
+        logger.error("Shutting down with %d rows that could not be saved to Google Sheets.", len(PENDING_ROWS))
+
+# --- Search Cache ---
+# Rendered results are cached per normalized query so repeated searches skip the search API
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", "1024"))
+SEARCH_CACHE_TTL = float(os.environ.get("SEARCH_CACHE_TTL", "3600"))
+
+class TTLCache:
+    """A bounded LRU cache whose entries expire ttl seconds after they are stored."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """Returns the cached value for key, or None if it is missing or expired."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value) -> None:
+        """Stores value under key, evicting the least recently used entry when full."""
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+SEARCH_CACHE = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+
+# --- Submission State ---
+
+class Submission:
+    """The data points a user has collected so far for one dataset row."""
+
+    __slots__ = ("data_points",)
+
+    def __init__(self):
+        self.data_points = deque(maxlen=MAX_DATA_POINTS)
+
+@contextlib.contextmanager
+def active_submission(context: ContextTypes.DEFAULT_TYPE):
+    """Yields the user's submission (None if there is none) and discards it on exit."""
+    try:
+        yield context.user_data.get('submission')
+    finally:
+        context.user_data.pop('submission', None)
+
+# --- Message Filters ---
+# Built once and shared by the conversation handlers
+
+# Plain text messages that are not commands
+TEXT_FILTER = filters.TEXT & ~filters.COMMAND
+# Data points: non-command text without control characters (tabs and line breaks are allowed),
+# so malformed input is rejected before get_data is scheduled
+DATA_FILTER = filters.Regex(re.compile(r"\A[^\x00-\x08\x0b\x0c\x0e-\x1f\x7f]{1,4096}\Z")) & ~filters.COMMAND
+
+# --- Data Collection Keyboards ---
+# Callback data for the buttons, shared by the keyboards and BUTTON_HANDLERS
+CB_SUBMIT_DATA = "submit_data"
+CB_ADD_MORE_DATA = "add_more_data"
+CB_FINISH_SUBMISSION = "finish_submission"
+CB_CANCEL_SUBMISSION = "cancel_submission"
+
+# The keyboards are static, so they are built once and shared by every handler call
+
+# Example of an inline keyboard to guide input
+START_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("Submit Data Point", callback_data=CB_SUBMIT_DATA),
+        InlineKeyboardButton("Cancel", callback_data=CB_CANCEL_SUBMISSION),
+    ]
+])
+
+# You could offer more specific inline keyboard options here based on the data you expect
+GET_DATA_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("Add More Data", callback_data=CB_ADD_MORE_DATA),
+        InlineKeyboardButton("Finish Submission", callback_data=CB_FINISH_SUBMISSION),
+        InlineKeyboardButton("Cancel", callback_data=CB_CANCEL_SUBMISSION),
+    ]
+])
 
 # --- Data Collection Command Handlers ---
 
@@ -62,127 +334,200 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         "Send me the data you want to add to the dataset. Type /cancel to stop at any time.",
     )
 
-    # Example of an inline keyboard to guide input
-    keyboard = [
-        [
-            InlineKeyboardButton("Submit Data Point", callback_data="submit_data"),
-            InlineKeyboardButton("Cancel", callback_data="cancel_submission"),
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     await update.message.reply_text(
         "Please select an action:",
-        reply_markup=reply_markup
+        reply_markup=START_MARKUP
     )
 
     return GET_DATA # Move to the GET_DATA state
 
 async def get_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Receives the data from the user and processes it."""
-    user_data = context.user_data
     data_point = update.message.text
 
-    if 'current_data' not in user_data:
-        user_data['current_data'] = []
+    submission = context.user_data.get('submission')
+    if submission is None:
+        submission = context.user_data['submission'] = Submission()
 
-    user_data['current_data'].append(data_point)
+    if len(submission.data_points) >= MAX_DATA_POINTS:
+        await update.message.reply_text(
+            f"A submission can hold at most {MAX_DATA_POINTS} data points. Please finish or cancel it."
+        )
+        return GET_DATA
 
-    await update.message.reply_text("Received your data point. Add another one or use the buttons.")
-
-    # You could offer more specific inline keyboard options here based on the data you expect
-    keyboard = [
-        [
-            InlineKeyboardButton("Add More Data", callback_data="add_more_data"),
-            InlineKeyboardButton("Finish Submission", callback_data="finish_submission"),
-            InlineKeyboardButton("Cancel", callback_data="cancel_submission"),
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    submission.data_points.append(data_point)
 
     await update.message.reply_text(
-        "What would you like to do next?",
-        reply_markup=reply_markup
+        "Received your data point. Add another one or choose what to do next:",
+        reply_markup=GET_DATA_MARKUP
     )
 
     return GET_DATA # Stay in the GET_DATA state to receive more input
 
-async def data_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Handles inline keyboard button presses for data collection."""
+async def reject_data_point(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Replies to text that DATA_FILTER did not accept as a data point."""
+    await update.message.reply_text("That data point contains unsupported characters. Please send plain text.")
+    return GET_DATA # Stay in the GET_DATA state
+
+async def ask_for_data_point(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Handles the "Submit Data Point" and "Add More Data" buttons."""
+    await update.callback_query.edit_message_text(text="Okay, send me the data point.")
+    return GET_DATA # Stay or move to GET_DATA state
+
+async def finish_submission(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Handles the "Finish Submission" button."""
     query = update.callback_query
-    await query.answer() # Acknowledge the button press
 
-    user_data = context.user_data
-
-    if query.data == 'submit_data' or query.data == 'add_more_data':
-        await query.edit_message_text(text="Okay, send me the data point.")
-        return GET_DATA # Stay or move to GET_DATA state
-
-    elif query.data == 'finish_submission':
-        if 'current_data' in user_data and user_data['current_data']:
-            if worksheet:
-                try:
-                    # Append the collected data to the Google Sheet
-                    worksheet.append_row(user_data['current_data'])
-                    await query.edit_message_text(text="Data successfully added to the dataset!")
-                    logger.info(f"Data added to sheet: {user_data['current_data']}")
-                except Exception as e:
-                    await query.edit_message_text(text="Sorry, there was an error adding data to the sheet.")
-                    logger.error(f"Error appending data to Google Sheet: {e}")
+    with active_submission(context) as submission:
+        if submission and submission.data_points:
+            # Queue the collected data; the flusher writes it to the Google Sheet in batches
+            if await queue_row(list(submission.data_points)):
+                await query.edit_message_text(text="Data received and queued for the dataset!")
             else:
-                 await query.edit_message_text(text="Sorry, could not connect to Google Sheets. Data not saved.")
-
-            user_data.pop('current_data', None) # Clear the collected data
+                await query.edit_message_text(text="Sorry, could not connect to Google Sheets. Data not saved.")
         else:
             await query.edit_message_text(text="No data collected yet.")
 
-        return ConversationHandler.END # End the conversation
+    return ConversationHandler.END # End the conversation
+
+async def cancel_submission(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Handles the "Cancel" button."""
+    with active_submission(context): # Clear any collected data
+        await update.callback_query.edit_message_text(text="Data submission cancelled.")
+    return ConversationHandler.END # End the conversation
 
-    elif query.data == 'cancel_submission':
-        user_data.pop('current_data', None) # Clear any collected data
-        await query.edit_message_text(text="Data submission cancelled.")
-        return ConversationHandler.END # End the conversation
+# Maps each button's callback data to the handler for that button
+BUTTON_HANDLERS = {
+    CB_SUBMIT_DATA: ask_for_data_point,
+    CB_ADD_MORE_DATA: ask_for_data_point,
+    CB_FINISH_SUBMISSION: finish_submission,
+    CB_CANCEL_SUBMISSION: cancel_submission,
+}
+
+async def data_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Handles inline keyboard button presses for data collection."""
+    query = update.callback_query
+    await query.answer() # Acknowledge the button press
+
+    handler = BUTTON_HANDLERS.get(query.data)
+    if handler is None:
+        return GET_DATA # Unknown button, stay in the GET_DATA state
+    return await handler(update, context)
 
 async def cancel_data_collection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancels and ends the data collection conversation."""
-    user_data = context.user_data
-    user_data.pop('current_data', None) # Clear any collected data
-    await update.message.reply_text(
-        "Data submission cancelled. Bye!"
-    )
+    with active_submission(context): # Clear any collected data
+        await update.message.reply_text(
+            "Data submission cancelled. Bye!"
+        )
     return ConversationHandler.END # End the conversation
 
 # --- Search Command Handlers ---
 
+# Longest search reply message sent, leaving headroom under Telegram's 4096 character limit
+MAX_MESSAGE_LENGTH = 3900
+# Most queries accepted in a single search message
+MAX_SEARCH_QUERIES = int(os.environ.get("MAX_SEARCH_QUERIES", "5"))
+# Searches running at once across all users; kept below BLOCKING_IO_WORKERS so
+# searches cannot take every thread and hold up Google Sheets writes
+SEARCH_SEMAPHORE = asyncio.Semaphore(int(os.environ.get("SEARCH_CONCURRENCY", "4")))
+# Longest query echoed back in the "Searching for ..." message
+MAX_QUERY_PREVIEW_LENGTH = 100
+
 async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Starts the search conversation and asks for the query."""
-    await update.message.reply_text("What would you like to search for?")
+    await update.message.reply_text(
+        "What would you like to search for? Send several queries on separate lines to search them all at once."
+    )
     return RECEIVING_SEARCH_QUERY # Move to the state to receive the query
 
+def format_search_results(search_results) -> list[str]:
+    """Renders the results of a google_search call as reply text, one part per result."""
+    if not (search_results and search_results[0].results):
+        return []
+    return [
+        f"Title: {result.source_title or 'N/A'}\n"
+        f"URL: {result.url or 'N/A'}\n"
+        f"Snippet: {result.snippet or 'N/A'}\n"
+        for result in search_results[0].results
+    ]
+
+async def search_one(search_query: str) -> list[str]:
+    """Returns the rendered results for a single query, from the cache when possible."""
+    cache_key = search_query.casefold()
+    result_parts = SEARCH_CACHE.get(cache_key)
+    if result_parts is None:
+        # Use the google_search tool
+        async with SEARCH_SEMAPHORE:
+            search_results = await asyncio.to_thread(google_search, queries=[search_query])
+        result_parts = format_search_results(search_results)
+        # Empty responses are not cached, so a transient miss is retried on the next search
+        if result_parts:
+            SEARCH_CACHE.set(cache_key, result_parts)
+    return result_parts
+
 async def perform_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Receives the search query and performs the search."""
     search_query = update.message.text
-    await update.message.reply_text(f"Searching for '{search_query}'...")
-
+    # Every non-empty line is a separate query; they are searched concurrently
+    queries = [line.strip() for line in search_query.splitlines() if line.strip()]
+    if not queries:
+        await update.message.reply_text("Please send a search query.")
+        return RECEIVING_SEARCH_QUERY # Stay in the state to receive a query
+
+    if len(queries) > MAX_SEARCH_QUERIES:
+        await update.message.reply_text(
+            f"Please send at most {MAX_SEARCH_QUERIES} queries at a time, one per line."
+        )
+        return RECEIVING_SEARCH_QUERY # Stay in the state to receive a shorter query
+
+    if len(queries) == 1:
+        preview = queries[0]
+        if len(preview) > MAX_QUERY_PREVIEW_LENGTH:
+            preview = preview[:MAX_QUERY_PREVIEW_LENGTH] + "..."
+        await update.message.reply_text(f"Searching for '{preview}'...")
+    else:
+        await update.message.reply_text(f"Searching for {len(queries)} queries...")
+
+    # Results are sent in query order as soon as each query completes,
+    # split into messages that stay under Telegram's message length limit
+    searches = [asyncio.ensure_future(search_one(query)) for query in queries]
     try:
-        # Use the google_search tool
-        search_results = google_search(queries=[search_query])
-
-        if search_results and search_results[0].results:
-            reply_text = "Search Results:\n\n"
-            for result in search_results[0].results:
-                reply_text += f"Title: {result.source_title or 'N/A'}\n"
-                reply_text += f"URL: {result.url or 'N/A'}\n"
-                reply_text += f"Snippet: {result.snippet or 'N/A'}\n\n"
-        else:
-            reply_text = "No search results found."
-
-        await update.message.reply_text(reply_text)
+        for query, search in zip(queries, searches):
+            # A failed query is reported on its own; the remaining queries still get their results
+            try:
+                result_parts = await search
+            except Exception as e:
+                logger.error("Error during search for %r: %s", query, e)
+                await update.message.reply_text(f"Sorry, the search for '{query[:MAX_QUERY_PREVIEW_LENGTH]}' failed.")
+                continue
+
+            # The header is rendered per request, since cached results are shared by queries differing only in case
+            if result_parts:
+                reply_parts = [f"Search Results for '{query}':\n", *result_parts]
+            else:
+                reply_parts = [f"No search results found for '{query}'.\n"]
+
+            chunk, chunk_length = [], 0
+            for part in reply_parts:
+                part = part[:MAX_MESSAGE_LENGTH]
+                if chunk and chunk_length + len(part) > MAX_MESSAGE_LENGTH:
+                    await update.message.reply_text("\n".join(chunk))
+                    chunk, chunk_length = [], 0
+                chunk.append(part)
+                chunk_length += len(part) + 1
+            # Send this query's results now rather than holding them until later queries finish
+            await update.message.reply_text("\n".join(chunk))
 
     except Exception as e:
-        logger.error(f"Error during search: {e}")
+        logger.error("Error during search: %s", e)
         await update.message.reply_text("Sorry, an error occurred while performing the search.")
 
+    finally:
+        for search in searches:
+            search.cancel()
+        await asyncio.gather(*searches, return_exceptions=True)
+
     return ConversationHandler.END # End the search conversation
 
 async def cancel_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -191,6 +536,126 @@ async def cancel_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     return ConversationHandler.END # End the search conversation
 
 
+# --- Update Processing ---
+# Maximum number of updates (across all chats) handled at the same time
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", "256"))
+# Updates a single chat may have waiting behind the one being handled; further updates are dropped
+MAX_PENDING_UPDATES_PER_CHAT = int(os.environ.get("MAX_PENDING_UPDATES_PER_CHAT", "16"))
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Handles updates from different chats concurrently while keeping each chat's updates in order.
+
+    Each chat gets a queue and a single worker task that handles the chat's updates one
+    at a time. A worker only takes one of the max_concurrent_updates slots while it is
+    running an update, so a backlog in one busy chat never holds slots other chats need.
+    """
+
+    def __init__(self, max_concurrent_updates: int, max_pending_per_chat: int):
+        super().__init__(max_concurrent_updates)
+        self.max_pending_per_chat = max_pending_per_chat
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        self._chat_queues: dict[int, asyncio.Queue] = {}
+        self._chat_workers: dict[int, asyncio.Task] = {}
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._running:
+                await coroutine
+            return
+
+        # Only enqueue here; returning right away releases PTB's own slot for this update
+        queue = self._chat_queues.get(chat.id)
+        if queue is None:
+            queue = self._chat_queues[chat.id] = asyncio.Queue(maxsize=self.max_pending_per_chat)
+            self._chat_workers[chat.id] = asyncio.create_task(self._run_chat_worker(chat.id, queue))
+        try:
+            queue.put_nowait(coroutine)
+        except asyncio.QueueFull:
+            logger.warning("Dropping update %s: chat %s has too many pending updates.", update.update_id, chat.id)
+            coroutine.close()
+            await self._notify_dropped(update)
+
+    @staticmethod
+    async def _notify_dropped(update: Update) -> None:
+        """Tells the user their update was dropped, so button presses do not keep spinning."""
+        text = "I'm still working on your earlier messages. Please try again in a moment."
+        try:
+            if update.callback_query:
+                await update.callback_query.answer(text)
+            elif update.effective_message:
+                await update.effective_message.reply_text(text)
+        except Exception as e:
+            logger.error("Error notifying chat %s about a dropped update: %s", update.effective_chat.id, e)
+
+    async def _run_chat_worker(self, chat_id: int, queue: asyncio.Queue) -> None:
+        """Handles a chat's queued updates in order and exits once the queue is empty."""
+        while True:
+            coroutine = await queue.get()
+            try:
+                async with self._running:
+                    await coroutine
+            except Exception as e:
+                logger.error("Error handling update for chat %s: %s", chat_id, e)
+            if queue.empty():
+                # Forget idle chats so the bookkeeping only grows with the number of busy chats
+                del self._chat_queues[chat_id]
+                del self._chat_workers[chat_id]
+                return
+
+    async def drain(self) -> None:
+        """Waits until every chat worker has handled the updates already queued for it.
+
+        PTB considers an update handled as soon as it is queued here, so Application.stop()
+        does not wait for the workers; post_stop calls this while the bot can still reply.
+        """
+        while self._chat_workers:
+            await asyncio.gather(*list(self._chat_workers.values()), return_exceptions=True)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        # Runs after the bot has shut down, so updates still queued here can no longer be answered
+        workers = list(self._chat_workers.values())
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+        dropped = 0
+        for queue in self._chat_queues.values():
+            while not queue.empty():
+                queue.get_nowait().close()
+                dropped += 1
+        if dropped:
+            logger.warning("Dropped %d queued updates at shutdown.", dropped)
+        self._chat_queues.clear()
+        self._chat_workers.clear()
+
+
+async def post_init(application: Application) -> None:
+    """Starts the background sheet flusher once the event loop is running."""
+    # Cap concurrent blocking calls; asyncio.to_thread runs on the loop's default executor
+    asyncio.get_running_loop().set_default_executor(BLOCKING_IO_EXECUTOR)
+
+    # The Google Sheets connection is opened by the first flush, so startup does not wait on it
+    global sheet_flusher_task
+    sheet_flusher_task = asyncio.create_task(sheet_flusher())
+
+async def post_stop(application: Application) -> None:
+    """Lets the chat workers finish their queued updates before the bot shuts down."""
+    await application.update_processor.drain()
+
+async def post_shutdown(application: Application) -> None:
+    """Stops the sheet flusher, waits for it to write out any rows still pending and releases the thread pool."""
+    if sheet_flusher_task:
+        # Let the flusher finish its current flush instead of cancelling it mid-write
+        FLUSHER_STOPPING.set()
+        FLUSH_REQUESTED.set()
+        await sheet_flusher_task
+
+    BLOCKING_IO_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+
 def main() -> None:
     """Runs the bot."""
     # Replace with your actual bot token
@@ -200,14 +665,23 @@ def main() -> None:
         logger.error("Please replace 'YOUR_BOT_TOKEN' with your actual Telegram bot token or set the TELEGRAM_BOT_TOKEN environment variable.")
         return
 
-    application = Application.builder().token(TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES, MAX_PENDING_UPDATES_PER_CHAT))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Create the data collection conversation handler
     data_collection_conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
         states={
             GET_DATA: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, get_data),
+                MessageHandler(DATA_FILTER, get_data),
+                MessageHandler(TEXT_FILTER, reject_data_point),
                 CallbackQueryHandler(data_button), # Handle button presses in this state
             ],
         },
@@ -219,7 +693,7 @@ def main() -> None:
         entry_points=[CommandHandler("search", search_command)],
         states={
             RECEIVING_SEARCH_QUERY: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, perform_search),
+                MessageHandler(TEXT_FILTER, perform_search),
             ],
         },
         fallbacks=[CommandHandler("cancel", cancel_search)],
@@ -230,7 +704,24 @@ def main() -> None:
     application.add_handler(search_conv_handler)
 
     # Run the bot until the user presses Ctrl-C
-    application.run_polling(poll_interval=3)
+    # Set WEBHOOK_URL (public HTTPS base URL) to receive updates via webhook instead of polling.
+    # Webhooks need the webhooks extra: pip install "python-telegram-bot[webhooks]"
+    webhook_url = os.environ.get("WEBHOOK_URL")
+    if webhook_url:
+        if importlib.util.find_spec("tornado") is None:
+            logger.error("WEBHOOK_URL is set but webhook support is not installed. "
+                         "Install it with: pip install \"python-telegram-bot[webhooks]\"")
+            return
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.environ.get("PORT", "8443")),
+            url_path=TOKEN,
+            webhook_url=f"{webhook_url.rstrip('/')}/{TOKEN}",
+            drop_pending_updates=True,
+        )
+    else:
+        # Long polling: Telegram holds each getUpdates request open until an update arrives
+        application.run_polling(poll_interval=0.0, timeout=30, drop_pending_updates=True)
 
 if __name__ == "__main__":
     main()